@@ -1,12 +1,14 @@
 
 import os
-import json
 import time
+import asyncio
+import functools
 import sqlite3
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import Optional, Any, Dict, List
+from typing import Optional, Any, Dict, Iterable, List, Tuple
 
 import numpy as np
 import cv2
@@ -15,8 +17,15 @@ from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
+import orjson
 from lxml import etree
-from tak_bridge import TAKBridge
+from tak_bridge import TAKBridge, classify_cot_type, cot_attr, find_cot_element
+
+# Optional SIMD JPEG encoder (PyTurboJPEG + libjpeg-turbo); falls back to OpenCV
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+except ImportError:
+    TurboJPEG = None
 
 APP_TITLE = "Tactical COP Lite"
 DB_PATH = os.getenv("COP_DB_PATH", "cop.db")
@@ -32,64 +41,149 @@ TAK_CA = os.getenv("TAK_CA", "").strip()
 TAK_CALLSIGN = os.getenv("TAK_CALLSIGN", "COP-LITE").strip()
 TAK_PUSH_INTERVAL = int(os.getenv("TAK_PUSH_INTERVAL", "30"))
 
+# Shared parser for one-shot CoT documents posted to /tak/cot. External
+# entities and network access are blocked so posted XML cannot pull in files
+# or URLs; internal DTD entities are still expanded.
+COT_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def init_db() -> None:
-    conn = sqlite3.connect(DB_PATH)
+# Process-wide SQLite connection shared by the HTTP handlers and the TAK
+# bridge threads; opened in init_db() and serialized through _db_lock.
+_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+def connect_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+TRACKS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS tracks (
+        uid TEXT PRIMARY KEY,
+        side TEXT NOT NULL,
+        layer TEXT NOT NULL,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL,
+        updated_at TEXT NOT NULL,
+        meta_json TEXT NOT NULL
+    ) WITHOUT ROWID
+"""
+
+def _migrate_tracks_without_rowid(conn: sqlite3.Connection) -> None:
+    # Databases created before tracks became WITHOUT ROWID are rebuilt once
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='tracks'").fetchone()
+    if row is None or "WITHOUT ROWID" in row[0].upper():
+        return
+    conn.execute("BEGIN")
     try:
+        conn.execute("ALTER TABLE tracks RENAME TO tracks_legacy")
+        conn.execute(TRACKS_TABLE_SQL)
         conn.execute("""
-            CREATE TABLE IF NOT EXISTS tracks (
-                uid TEXT PRIMARY KEY,
-                side TEXT NOT NULL,
-                layer TEXT NOT NULL,
-                lat REAL NOT NULL,
-                lon REAL NOT NULL,
-                updated_at TEXT NOT NULL,
-                meta_json TEXT NOT NULL
-            )
+            INSERT INTO tracks(uid, side, layer, lat, lon, updated_at, meta_json)
+            SELECT uid, side, layer, lat, lon, updated_at, meta_json FROM tracks_legacy
         """)
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute("DROP TABLE tracks_legacy")
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
 
-def upsert_track(uid: str, side: str, layer: str, lat: float, lon: float, meta: Dict[str, Any]) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        conn.execute("""
-            INSERT INTO tracks(uid, side, layer, lat, lon, updated_at, meta_json)
-            VALUES(?,?,?,?,?,?,?)
-            ON CONFLICT(uid) DO UPDATE SET
-                side=excluded.side,
-                layer=excluded.layer,
-                lat=excluded.lat,
-                lon=excluded.lon,
-                updated_at=excluded.updated_at,
-                meta_json=excluded.meta_json
-        """, (uid, side, layer, lat, lon, utc_now_iso(), json.dumps(meta or {})))
-        conn.commit()
-    finally:
-        conn.close()
+def init_db() -> None:
+    global _conn
+    with _db_lock:
+        if _conn is None:
+            _conn = connect_db()
+        _migrate_tracks_without_rowid(_conn)
+        _conn.execute(TRACKS_TABLE_SQL)
+
+def close_db() -> None:
+    global _conn
+    with _db_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+UPSERT_TRACK_SQL = """
+    INSERT INTO tracks(uid, side, layer, lat, lon, updated_at, meta_json)
+    VALUES(?,?,?,?,?,?,?)
+    ON CONFLICT(uid) DO UPDATE SET
+        side=excluded.side,
+        layer=excluded.layer,
+        lat=excluded.lat,
+        lon=excluded.lon,
+        updated_at=excluded.updated_at,
+        meta_json=excluded.meta_json
+"""
+
+LIST_TRACKS_SQL = "SELECT uid, side, layer, lat, lon, updated_at, meta_json FROM tracks"
+LIST_TRACKS_FOR_COT_SQL = "SELECT uid, side, lat, lon FROM tracks"
+
+def upsert_track(uid: str, side: str, layer: str, lat: float, lon: float, meta: Dict[str, Any],
+                 updated_at: Optional[str] = None) -> None:
+    params = (uid, side, layer, lat, lon, updated_at or utc_now_iso(), orjson.dumps(meta or {}).decode())
+    with _db_lock:
+        _conn.execute(UPSERT_TRACK_SQL, params)
+
+def upsert_tracks_many(rows: Iterable[Tuple[str, str, str, float, float, Dict[str, Any]]],
+                       updated_at: Optional[str] = None) -> int:
+    # one timestamp for the whole batch
+    now = updated_at or utc_now_iso()
+    params = [(uid, side, layer, lat, lon, now, orjson.dumps(meta or {}).decode())
+              for uid, side, layer, lat, lon, meta in rows]
+    if not params:
+        return 0
+    with _db_lock:
+        _conn.execute("BEGIN")
+        try:
+            _conn.executemany(UPSERT_TRACK_SQL, params)
+            _conn.execute("COMMIT")
+        except Exception:
+            # never leave the shared connection inside an open transaction
+            if _conn.in_transaction:
+                _conn.execute("ROLLBACK")
+            raise
+    return len(params)
 
 def list_tracks() -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        cur = conn.execute("SELECT uid, side, layer, lat, lon, updated_at, meta_json FROM tracks")
-        rows = cur.fetchall()
-        out = []
-        for uid, side, layer, lat, lon, updated_at, meta_json in rows:
-            out.append({
-                "uid": uid,
-                "side": side,
-                "layer": layer,
-                "lat": lat,
-                "lon": lon,
-                "updated_at": updated_at,
-                "meta": json.loads(meta_json or "{}")
-            })
-        return out
-    finally:
-        conn.close()
+    with _db_lock:
+        rows = _conn.execute(LIST_TRACKS_SQL).fetchall()
+    out = []
+    for uid, side, layer, lat, lon, updated_at, meta_json in rows:
+        out.append({
+            "uid": uid,
+            "side": side,
+            "layer": layer,
+            "lat": lat,
+            "lon": lon,
+            "updated_at": updated_at,
+            "meta": orjson.loads(meta_json or "{}")
+        })
+    return out
+
+def list_tracks_for_cot() -> List[Tuple[str, str, float, float]]:
+    # CoT export only needs position and side; skip building dicts and decoding meta
+    with _db_lock:
+        return _conn.execute(LIST_TRACKS_FOR_COT_SQL).fetchall()
+
+# Async endpoints hand DB work to one dedicated thread: every call serializes
+# on _db_lock anyway, and waiting requests no longer tie up the shared
+# threadpool (also used by MJPEG streams) or block the event loop.
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cop-db")
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
 
 class TrackIn(BaseModel):
     uid: str = Field(..., description="Unique track ID")
@@ -110,6 +204,7 @@ async def lifespan(app):
     yield
     if tak_bridge:
         tak_bridge.stop()
+    close_db()
 
 app = FastAPI(title=APP_TITLE, lifespan=lifespan)
 
@@ -122,76 +217,82 @@ def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request, "app_title": APP_TITLE})
 
 @app.get("/api/tracks")
-def api_tracks():
-    return {"tracks": list_tracks(), "server_time": utc_now_iso()}
+async def api_tracks():
+    return {"tracks": await run_db(list_tracks), "server_time": utc_now_iso()}
 
 @app.post("/api/tracks")
-def api_upsert(track: TrackIn):
+async def api_upsert(track: TrackIn):
     # Basic validation for demo (keep simple)
     if track.side not in {"friendly", "enemy", "neutral", "unknown"}:
         raise HTTPException(status_code=400, detail="Invalid side")
     if track.layer not in {"friendly", "enemy", "fires", "air", "ew", "other"}:
         raise HTTPException(status_code=400, detail="Invalid layer")
-    upsert_track(track.uid, track.side, track.layer, track.lat, track.lon, track.meta)
-    return {"ok": True, "updated_at": utc_now_iso()}
+    now = utc_now_iso()
+    try:
+        await run_db(upsert_track, track.uid, track.side, track.layer, track.lat, track.lon, track.meta, updated_at=now)
+    except orjson.JSONEncodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid meta: {e}")
+    return {"ok": True, "updated_at": now}
 
 @app.post("/ingest/bft")
-def ingest_bft(batch: BFTBatch):
-    for t in batch.tracks:
-        upsert_track(t.uid, t.side, t.layer, t.lat, t.lon, t.meta)
+async def ingest_bft(batch: BFTBatch):
+    rows = [(t.uid, t.side, t.layer, t.lat, t.lon, t.meta) for t in batch.tracks]
+    try:
+        await run_db(upsert_tracks_many, rows)
+    except orjson.JSONEncodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid meta: {e}")
     return {"ok": True, "count": len(batch.tracks)}
 
+PULL_COT_TEMPLATE = (
+    '<event version="2.0" uid="{uid}" type="{typ}" how="m-g" time="{ts}" start="{ts}" stale="{stale}">'
+    '<point lat="{lat}" lon="{lon}" hae="0" ce="25" le="25"/></event>'
+)
+PULL_COT_TYPES = {"friendly": "a-f-G-U-C", "enemy": "a-h-G-U-C"}
+
+def render_tracks_cot() -> str:
+    # fetch and render together so large exports stay off the event loop
+    rows = list_tracks_for_cot()
+    now = datetime.now(timezone.utc)
+    ts = now.isoformat()
+    stale = now.replace(microsecond=0).isoformat()
+    return "\n".join(
+        PULL_COT_TEMPLATE.format(
+            uid=cot_attr(uid),
+            typ=PULL_COT_TYPES.get(side, "b-m-p-s-m"),
+            ts=ts,
+            stale=stale,
+            lat=lat,
+            lon=lon,
+        )
+        for uid, side, lat, lon in rows
+    )
+
 # --- TAK Cursor-on-Target (CoT) ingest (very minimal) ---
 # Expects an <event ...><point lat=".." lon=".."/></event>
 @app.post("/tak/cot")
 async def ingest_cot(request: Request):
     raw = await request.body()
     try:
-        root = etree.fromstring(raw)
+        root = etree.fromstring(raw, COT_PARSER)
         uid = root.get("uid") or root.get("id") or f"COT-{int(time.time())}"
         cot_type = root.get("type", "")
-        side = "friendly" if cot_type.startswith("a-f") else "enemy" if cot_type.startswith("a-h") else "unknown"
-        # map side to layer for display
-        layer = "friendly" if side == "friendly" else "enemy" if side == "enemy" else "other"
-        # derive a default MIL-STD-2525C SIDC from the CoT type
-        aff = "F" if side == "friendly" else "H" if side == "enemy" else "U"
-        dim = "A" if cot_type.startswith(("a-f-A", "a-h-A")) else "G"
-        sidc = f"S{aff}{dim}P------*****"
-        pt = root.find(".//point")
+        # side, display layer and default MIL-STD-2525C SIDC from the CoT type
+        side, layer, sidc = classify_cot_type(cot_type)
+        pt = find_cot_element(root, "point")
         if pt is None:
             raise ValueError("No point element")
         lat = float(pt.get("lat"))
         lon = float(pt.get("lon"))
         meta = {"cot_type": cot_type, "how": root.get("how"), "time": root.get("time"), "start": root.get("start"), "stale": root.get("stale"), "sidc": sidc}
-        upsert_track(uid, side, layer, lat, lon, meta)
+        await run_db(upsert_track, uid, side, layer, lat, lon, meta)
         return {"ok": True, "uid": uid}
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid CoT: {e}")
 
 @app.get("/tak/cot/pull")
-def pull_cot():
+async def pull_cot():
     # Simple CoT export of all tracks (demo only)
-    tracks = list_tracks()
-    events = []
-    now = datetime.now(timezone.utc)
-    for t in tracks:
-        ev = etree.Element("event")
-        ev.set("version", "2.0")
-        ev.set("uid", t["uid"])
-        ev.set("type", "a-f-G-U-C" if t["side"] == "friendly" else "a-h-G-U-C" if t["side"] == "enemy" else "b-m-p-s-m")
-        ev.set("how", "m-g")
-        ts = now.isoformat()
-        ev.set("time", ts)
-        ev.set("start", ts)
-        ev.set("stale", (now.replace(microsecond=0)).isoformat())
-        pt = etree.SubElement(ev, "point")
-        pt.set("lat", str(t["lat"]))
-        pt.set("lon", str(t["lon"]))
-        pt.set("hae", "0")
-        pt.set("ce", "25")
-        pt.set("le", "25")
-        events.append(etree.tostring(ev, pretty_print=True))
-    xml = b"\n".join(events) if events else b""
+    xml = await run_db(render_tracks_cot)
     return Response(content=xml, media_type="application/xml")
 
 @app.get("/api/tak/status")
@@ -201,13 +302,30 @@ def api_tak_status():
     return {"enabled": True, **tak_bridge.status()}
 
 # --- MJPEG video streaming (RTSP -> MJPEG) ---
+MJPEG_PART_PREFIX = b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+
 class FrameSource:
+    TEST_W, TEST_H = 640, 360
+
     def __init__(self, rtsp_url: str):
         self.rtsp_url = rtsp_url
         self.lock = threading.Lock()
         self.frame_jpeg: Optional[bytes] = None
         self.running = False
         self.thread: Optional[threading.Thread] = None
+        self._subscribers: List[threading.Event] = []
+        self._encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), 75]
+        self._tj = None
+        if TurboJPEG is not None:
+            try:
+                self._tj = TurboJPEG()
+            except (OSError, RuntimeError):
+                pass  # native libturbojpeg not installed
+        # Test pattern: static label drawn once, copied into a reused frame each tick
+        self._base = np.zeros((self.TEST_H, self.TEST_W, 3), dtype=np.uint8)
+        msg = "FMV (TEST FEED)" if not self.rtsp_url else "FMV (RTSP)"
+        cv2.putText(self._base, msg, (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2, cv2.LINE_AA)
+        self._test_frame = np.empty_like(self._base)
 
     def start(self):
         if self.running:
@@ -216,40 +334,65 @@ class FrameSource:
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
 
+    def subscribe(self) -> threading.Event:
+        # each client gets an Event that is set whenever a new JPEG is ready
+        event = threading.Event()
+        with self.lock:
+            self._subscribers.append(event)
+        return event
+
+    def unsubscribe(self, event: threading.Event):
+        with self.lock:
+            self._subscribers.remove(event)
+
     def _run(self):
         cap = None
         if self.rtsp_url:
             cap = cv2.VideoCapture(self.rtsp_url)
         t0 = time.time()
         while self.running:
+            with self.lock:
+                watched = bool(self._subscribers)
             if cap is not None and cap.isOpened():
+                # keep reading so the capture never lags, even when nobody watches
                 ok, frame = cap.read()
                 if not ok:
                     # backoff and retry
                     time.sleep(0.2)
                     continue
             else:
+                time.sleep(0.03)
+                if not watched:
+                    continue
                 # Generate a simple test pattern (works out of the box)
-                w, h = 640, 360
-                frame = np.zeros((h, w, 3), dtype=np.uint8)
+                w = self.TEST_W
+                frame = self._test_frame
+                np.copyto(frame, self._base)
                 dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                msg = "FMV (TEST FEED)" if not self.rtsp_url else "FMV (RTSP)"
-                cv2.putText(frame, msg, (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2, cv2.LINE_AA)
                 cv2.putText(frame, dt, (20, 110), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255, 255, 255), 2, cv2.LINE_AA)
                 # moving bar
                 x = int(((time.time() - t0) * 60) % w)
                 cv2.rectangle(frame, (x, 150), (min(x + 80, w-1), 220), (255, 255, 255), -1)
-                time.sleep(0.03)
 
-            # Encode JPEG
-            ok, jpg = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), 75])
-            if ok:
+            # Encode JPEG only while a client is streaming
+            if not watched:
+                continue
+            jpg = self._encode(frame)
+            if jpg is not None:
                 with self.lock:
-                    self.frame_jpeg = jpg.tobytes()
+                    self.frame_jpeg = jpg
+                    for event in self._subscribers:
+                        event.set()
 
         if cap is not None:
             cap.release()
 
+    def _encode(self, frame: np.ndarray) -> Optional[bytes]:
+        if self._tj is not None:
+            return self._tj.encode(frame, quality=75, jpeg_subsample=TJSAMP_420)
+        ok, jpg = cv2.imencode(".jpg", frame, self._encode_params)
+        return jpg.tobytes() if ok else None
+
     def get_jpeg(self) -> Optional[bytes]:
         with self.lock:
             return self.frame_jpeg
@@ -269,6 +412,7 @@ if TAK_HOST:
         callsign=TAK_CALLSIGN,
         push_interval=TAK_PUSH_INTERVAL,
         upsert_fn=upsert_track,
+        upsert_many_fn=upsert_tracks_many,
         list_fn=list_tracks,
     )
 
@@ -277,17 +421,17 @@ def video_mjpeg():
     frame_source.start()
 
     def gen():
-        boundary = b"--frame"
-        while True:
-            jpg = frame_source.get_jpeg()
-            if jpg is None:
-                time.sleep(0.05)
-                continue
-            yield boundary + b"\r\n"
-            yield b"Content-Type: image/jpeg\r\n"
-            yield f"Content-Length: {len(jpg)}\r\n\r\n".encode("utf-8")
-            yield jpg + b"\r\n"
-            time.sleep(0.05)
+        new_frame = frame_source.subscribe()
+        try:
+            while True:
+                if not new_frame.wait(timeout=1.0):
+                    continue
+                new_frame.clear()
+                jpg = frame_source.get_jpeg()
+                # one chunk per frame -> one socket write
+                yield MJPEG_PART_PREFIX + str(len(jpg)).encode() + b"\r\n\r\n" + jpg + b"\r\n"
+        finally:
+            frame_source.unsubscribe(new_frame)
 
     return StreamingResponse(gen(), media_type="multipart/x-mixed-replace; boundary=frame")
 
@@ -8,14 +8,17 @@ tracks back to the TAK Server and sends a self-SA heartbeat.
 The bridge is opt-in: it only starts when TAK_HOST is configured.
 """
 
+import functools
 import logging
 import os
+import select
 import socket
 import ssl
 import threading
 import time
 from datetime import datetime, timedelta, timezone
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
 
 from lxml import etree
 
@@ -23,6 +26,82 @@ log = logging.getLogger("tak_bridge")
 
 SA_INTERVAL = 15  # seconds between self-SA heartbeats
 MAX_BUF = 1 << 20  # 1 MB buffer limit before discard
+RECV_SIZE = 1 << 16  # 64 KB per recv() on busy streams
+END_TAG = b"</event>"
+
+# One parser reused for every inbound event instead of a default parser per
+# fromstring() call; external entities and network access are blocked
+COT_PARSER = etree.XMLParser(
+    recover=True, resolve_entities=False, no_network=True, huge_tree=False
+)
+
+# Outbound CoT events have a fixed shape, so they are rendered from a string
+# template rather than built as an element tree.
+COT_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<event version="2.0" uid="{uid}" type="{typ}" how="m-g" time="{ts}" start="{ts}" stale="{stale}">'
+    '<point lat="{lat}" lon="{lon}" hae="0" ce="25" le="25"/>'
+    '<detail><contact callsign="{cs}"/></detail></event>'
+)
+
+SA_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<event version="2.0" uid="{cs}" type="a-f-G-U-C" how="h-g-i-g-o" time="{t}" start="{t}" stale="{s}">'
+    '<point lat="0.0" lon="0.0" hae="0" ce="9999999" le="9999999"/>'
+    '<detail><contact callsign="{cs}"/><__group name="Cyan" role="HQ"/>'
+    '<takv os="COP-Lite" version="1.0.0" device="server" platform="Tactical COP Lite"/></detail></event>'
+)
+
+DEFAULT_COT_TYPES = {
+    "friendly": "a-f-G-U-C",
+    "enemy": "a-h-G-U-C",
+    "neutral": "a-n-G-U-C",
+}
+
+_ATTR_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#9;"}
+
+
+def cot_attr(value: Any) -> str:
+    return escape(str(value), _ATTR_ENTITIES)
+
+
+def find_cot_element(root: etree._Element, path: str) -> Optional[etree._Element]:
+    # well-formed CoT keeps these as direct children; search deeper only if not
+    el = root.find(path)
+    if el is None:
+        el = root.find(".//" + path)
+    return el
+
+
+def classify_cot_type(cot_type: str) -> Tuple[str, str, str]:
+    """Map a CoT type string to (side, layer, MIL-STD-2525C SIDC)."""
+    # only the first five characters matter; caching on that prefix keeps
+    # the cache small and avoids pinning large untrusted type strings
+    return _classify(cot_type[:5])
+
+
+@functools.lru_cache(maxsize=512)
+def _classify(cot_type: str) -> Tuple[str, str, str]:
+    if cot_type.startswith("a-f"):
+        side = "friendly"
+    elif cot_type.startswith("a-h"):
+        side = "enemy"
+    elif cot_type.startswith("a-n"):
+        side = "neutral"
+    else:
+        side = "unknown"
+
+    if side == "friendly":
+        layer = "friendly"
+    elif side == "enemy":
+        layer = "enemy"
+    else:
+        layer = "other"
+
+    # derive SIDC
+    aff = {"friendly": "F", "enemy": "H", "neutral": "N"}.get(side, "U")
+    dim = "A" if cot_type[4:5] == "A" else "G"
+    return side, layer, f"S{aff}{dim}P------*****"
 
 # ---------------------------------------------------------------------------
 # TAKBridge
@@ -41,6 +120,7 @@ class TAKBridge:
         push_interval: int = 30,
         upsert_fn: Optional[Callable] = None,
         list_fn: Optional[Callable] = None,
+        upsert_many_fn: Optional[Callable] = None,
     ):
         self.host = host
         self.port = port
@@ -49,9 +129,11 @@ class TAKBridge:
         self.key_path = key_path
         self.ca_path = ca_path
         self.callsign = callsign
+        self._callsign_attr = cot_attr(callsign)
         self.push_interval = push_interval
         self._upsert_track = upsert_fn
         self._list_tracks = list_fn
+        self._upsert_tracks_many = upsert_many_fn
 
         self._lock = threading.Lock()
         self._running = False
@@ -111,6 +193,8 @@ class TAKBridge:
 
     def _connect(self) -> socket.socket:
         raw = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # pushes are coalesced into one sendall, so Nagle only adds latency
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         raw.settimeout(10)
         raw.connect((self.host, self.port))
 
@@ -125,7 +209,9 @@ class TAKBridge:
                 ctx.load_cert_chain(certfile=self.cert_path, keyfile=self.key_path)
             raw = ctx.wrap_socket(raw, server_hostname=self.host)
 
-        raw.settimeout(None)  # blocking for recv
+        # blocking after connect: a timed-out sendall could leave a truncated
+        # event on the stream; _stream_recv uses select() to notice stop()
+        raw.settimeout(None)
         return raw
 
     def _close_socket(self):
@@ -160,6 +246,8 @@ class TAKBridge:
                 self._stream_recv(sock)
 
             except Exception as e:
+                if not self._running:
+                    break  # socket closed by stop()
                 with self._lock:
                     self._connected = False
                     self._last_error = str(e)
@@ -176,28 +264,31 @@ class TAKBridge:
 
     def _stream_recv(self, sock: socket.socket):
         buf = b""
-        END_TAG = b"</event>"
         while self._running:
-            try:
-                chunk = sock.recv(4096)
-            except socket.timeout:
-                continue
+            # wake up every second to notice stop(); TLS may already hold
+            # decrypted bytes that select() cannot see
+            if not (isinstance(sock, ssl.SSLSocket) and sock.pending()):
+                ready, _, _ = select.select([sock], [], [], 1.0)
+                if not ready:
+                    continue
+            chunk = sock.recv(RECV_SIZE)
             if not chunk:
                 log.info("TAK Server closed connection")
                 return
 
             buf += chunk
 
-            # safety: discard oversized buffer (malformed stream)
-            if len(buf) > MAX_BUF:
-                log.warning("Buffer exceeded %d bytes, discarding", MAX_BUF)
-                buf = b""
-                continue
-
-            while END_TAG in buf:
-                end_idx = buf.index(END_TAG) + len(END_TAG)
-                raw_event = buf[:end_idx]
-                buf = buf[end_idx:]
+            # split on </event> so a malformed event only loses itself;
+            # events completed by this chunk are stored in one transaction
+            rows = []
+            start = 0
+            while True:
+                end_idx = buf.find(END_TAG, start)
+                if end_idx < 0:
+                    break
+                end_idx += len(END_TAG)
+                raw_event = buf[start:end_idx]
+                start = end_idx
 
                 start_idx = raw_event.find(b"<event")
                 if start_idx < 0:
@@ -205,58 +296,60 @@ class TAKBridge:
                 raw_event = raw_event[start_idx:]
 
                 try:
-                    root = etree.fromstring(raw_event)
-                    self._handle_event(root)
-                    with self._lock:
-                        self._events_received += 1
+                    root = etree.fromstring(raw_event, COT_PARSER)
                 except etree.XMLSyntaxError as xe:
                     log.debug("Malformed CoT event, skipping: %s", xe)
+                    continue
+                if root is None:
+                    continue
+                row = self._handle_event(root)
+                if row is not None:
+                    rows.append(row)
+                with self._lock:
+                    self._events_received += 1
+            buf = buf[start:]
+
+            if rows:
+                self._store_rows(rows)
+
+            # safety: discard oversized partial event (malformed stream)
+            if len(buf) > MAX_BUF:
+                log.warning("Buffer exceeded %d bytes, discarding", MAX_BUF)
+                buf = b""
+
+    def _store_rows(self, rows: List[Tuple[str, str, str, float, float, Dict[str, Any]]]):
+        if self._upsert_tracks_many:
+            self._upsert_tracks_many(rows)
+        elif self._upsert_track:
+            for row in rows:
+                self._upsert_track(*row)
 
     # -- event handling ------------------------------------------------------
 
-    def _handle_event(self, root: etree._Element):
+    def _handle_event(self, root: etree._Element) -> Optional[Tuple[str, str, str, float, float, Dict[str, Any]]]:
         uid = root.get("uid") or root.get("id")
         if not uid:
-            return
+            return None
         # skip our own heartbeat
         if uid == self.callsign:
-            return
+            return None
 
         cot_type = root.get("type", "")
 
-        if cot_type.startswith("a-f"):
-            side = "friendly"
-        elif cot_type.startswith("a-h"):
-            side = "enemy"
-        elif cot_type.startswith("a-n"):
-            side = "neutral"
-        else:
-            side = "unknown"
-
-        if side == "friendly":
-            layer = "friendly"
-        elif side == "enemy":
-            layer = "enemy"
-        else:
-            layer = "other"
-
-        # derive SIDC
-        aff = {"friendly": "F", "enemy": "H", "neutral": "N"}.get(side, "U")
-        dim = "A" if len(cot_type) > 4 and cot_type[4:5] == "A" else "G"
-        sidc = f"S{aff}{dim}P------*****"
-
-        pt = root.find(".//point")
+        side, layer, sidc = classify_cot_type(cot_type)
+
+        pt = find_cot_element(root, "point")
         if pt is None:
-            return
+            return None
         try:
             lat = float(pt.get("lat"))
             lon = float(pt.get("lon"))
         except (TypeError, ValueError):
-            return
+            return None
 
         # extract callsign from <detail><contact callsign="..."/>
         callsign = uid
-        contact = root.find(".//detail/contact")
+        contact = find_cot_element(root, "detail/contact")
         if contact is not None and contact.get("callsign"):
             callsign = contact.get("callsign")
 
@@ -271,8 +364,7 @@ class TAKBridge:
             "source": "tak_server",
         }
 
-        if self._upsert_track:
-            self._upsert_track(uid, side, layer, lat, lon, meta)
+        return uid, side, layer, lat, lon, meta
 
     # -- send loop -----------------------------------------------------------
 
@@ -310,38 +402,9 @@ class TAKBridge:
         now = datetime.now(timezone.utc)
         stale = now + timedelta(seconds=30)
         fmt = "%Y-%m-%dT%H:%M:%SZ"
-
-        ev = etree.Element("event")
-        ev.set("version", "2.0")
-        ev.set("uid", self.callsign)
-        ev.set("type", "a-f-G-U-C")
-        ev.set("how", "h-g-i-g-o")
-        ev.set("time", now.strftime(fmt))
-        ev.set("start", now.strftime(fmt))
-        ev.set("stale", stale.strftime(fmt))
-
-        pt = etree.SubElement(ev, "point")
-        pt.set("lat", "0.0")
-        pt.set("lon", "0.0")
-        pt.set("hae", "0")
-        pt.set("ce", "9999999")
-        pt.set("le", "9999999")
-
-        detail = etree.SubElement(ev, "detail")
-        contact = etree.SubElement(detail, "contact")
-        contact.set("callsign", self.callsign)
-
-        group = etree.SubElement(detail, "__group")
-        group.set("name", "Cyan")
-        group.set("role", "HQ")
-
-        takv = etree.SubElement(detail, "takv")
-        takv.set("os", "COP-Lite")
-        takv.set("version", "1.0.0")
-        takv.set("device", "server")
-        takv.set("platform", "Tactical COP Lite")
-
-        sock.sendall(etree.tostring(ev, xml_declaration=True, encoding="UTF-8"))
+        ts = now.strftime(fmt)
+        sa = SA_TEMPLATE.format(cs=self._callsign_attr, t=ts, s=stale.strftime(fmt))
+        sock.sendall(sa.encode("utf-8"))
 
     # -- push local tracks ---------------------------------------------------
 
@@ -356,46 +419,26 @@ class TAKBridge:
         fmt = "%Y-%m-%dT%H:%M:%SZ"
         stale_ts = (now + timedelta(seconds=self.push_interval + 15)).strftime(fmt)
         ts = now.strftime(fmt)
-        sent = 0
+        out = []
 
         for t in tracks:
+            meta = t.get("meta", {})
             # skip tracks that came from TAK Server (prevent echo loop)
-            if t.get("meta", {}).get("source") == "tak_server":
+            if meta.get("source") == "tak_server":
                 continue
 
-            side = t["side"]
-            if side == "friendly":
-                default_type = "a-f-G-U-C"
-            elif side == "enemy":
-                default_type = "a-h-G-U-C"
-            elif side == "neutral":
-                default_type = "a-n-G-U-C"
-            else:
-                default_type = "a-u-G-U-C"
-
-            ev = etree.Element("event")
-            ev.set("version", "2.0")
-            ev.set("uid", t["uid"])
-            ev.set("type", t.get("meta", {}).get("cot_type", default_type))
-            ev.set("how", "m-g")
-            ev.set("time", ts)
-            ev.set("start", ts)
-            ev.set("stale", stale_ts)
-
-            pt = etree.SubElement(ev, "point")
-            pt.set("lat", str(t["lat"]))
-            pt.set("lon", str(t["lon"]))
-            pt.set("hae", "0")
-            pt.set("ce", "25")
-            pt.set("le", "25")
-
-            detail = etree.SubElement(ev, "detail")
-            contact = etree.SubElement(detail, "contact")
-            contact.set("callsign", t.get("meta", {}).get("callsign", t["uid"]))
-
-            sock.sendall(etree.tostring(ev, xml_declaration=True, encoding="UTF-8"))
-            sent += 1
-
-        if sent:
+            default_type = DEFAULT_COT_TYPES.get(t["side"], "a-u-G-U-C")
+            out.append(COT_TEMPLATE.format(
+                uid=cot_attr(t["uid"]),
+                typ=cot_attr(meta.get("cot_type", default_type)),
+                ts=ts,
+                stale=stale_ts,
+                lat=t["lat"],
+                lon=t["lon"],
+                cs=cot_attr(meta.get("callsign", t["uid"])),
+            ))
+
+        if out:
+            sock.sendall("".join(out).encode("utf-8"))
             with self._lock:
-                self._events_sent += sent
+                self._events_sent += len(out)
@@ -0,0 +1,13 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point the app at a fresh SQLite file and open the shared connection."""
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "cop.db"))
+    main.close_db()
+    main.init_db()
+    yield tmp_path / "cop.db"
+    main.close_db()
@@ -0,0 +1,39 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+BIG = 2 ** 70  # wider than orjson's 64-bit integer range
+
+
+@pytest.fixture
+def client(db):
+    with TestClient(main.app) as c:
+        yield c
+
+
+def track(uid: str, **meta):
+    return {"uid": uid, "side": "friendly", "layer": "friendly", "lat": 1.0, "lon": 2.0, "meta": meta}
+
+
+def test_api_upsert_rejects_unencodable_meta(client):
+    r = client.post("/api/tracks", json=track("A", n=BIG))
+    assert r.status_code == 400
+    assert r.json()["detail"].startswith("Invalid meta")
+    assert client.get("/api/tracks").json()["tracks"] == []
+
+
+def test_ingest_bft_rejects_unencodable_meta(client):
+    r = client.post("/ingest/bft", json={"tracks": [track("A"), track("B", n=BIG)]})
+    assert r.status_code == 400
+    assert r.json()["detail"].startswith("Invalid meta")
+    assert client.get("/api/tracks").json()["tracks"] == []
+
+
+def test_api_upsert_and_ingest_bft_round_trip_meta(client):
+    assert client.post("/api/tracks", json=track("A", callsign="ALPHA")).status_code == 200
+    r = client.post("/ingest/bft", json={"tracks": [track("B", n=2 ** 40)]})
+    assert r.json() == {"ok": True, "count": 1}
+    tracks = {t["uid"]: t for t in client.get("/api/tracks").json()["tracks"]}
+    assert tracks["A"]["meta"] == {"callsign": "ALPHA"}
+    assert tracks["B"]["meta"] == {"n": 2 ** 40}
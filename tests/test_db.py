@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+def test_upsert_tracks_many_shares_timestamp_and_keeps_last_duplicate(db):
+    count = main.upsert_tracks_many([
+        ("A", "friendly", "friendly", 1.0, 2.0, {"callsign": "ALPHA"}),
+        ("B", "enemy", "enemy", 3.0, 4.0, {}),
+        ("A", "friendly", "friendly", 5.0, 6.0, {"callsign": "ALPHA 2"}),
+    ])
+    assert count == 3
+
+    tracks = {t["uid"]: t for t in main.list_tracks()}
+    assert sorted(tracks) == ["A", "B"]
+    assert (tracks["A"]["lat"], tracks["A"]["lon"]) == (5.0, 6.0)
+    assert tracks["A"]["meta"] == {"callsign": "ALPHA 2"}
+    assert tracks["A"]["updated_at"] == tracks["B"]["updated_at"]
+
+
+def test_upsert_tracks_many_rolls_back_failed_batch(db):
+    main.upsert_track("KEEP", "friendly", "friendly", 1.0, 1.0, {})
+
+    with pytest.raises(sqlite3.IntegrityError):
+        main.upsert_tracks_many([
+            ("NEW", "enemy", "enemy", 2.0, 2.0, {}),
+            ("BAD", "enemy", "enemy", None, 2.0, {}),  # lat is NOT NULL
+        ])
+
+    assert not main._conn.in_transaction
+    assert [t["uid"] for t in main.list_tracks()] == ["KEEP"]
+
+    main.upsert_track("AFTER", "enemy", "enemy", 3.0, 3.0, {})
+    assert sorted(t["uid"] for t in main.list_tracks()) == ["AFTER", "KEEP"]
+
+
+LEGACY_TRACKS_SQL = """
+    CREATE TABLE tracks (
+        uid TEXT PRIMARY KEY,
+        side TEXT NOT NULL,
+        layer TEXT NOT NULL,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL,
+        updated_at TEXT NOT NULL,
+        meta_json TEXT NOT NULL
+    )
+"""
+
+LEGACY_ROWS = [
+    ("FRD-001", "friendly", "friendly", 50.1109, 8.6821, "2024-01-01T00:00:00+00:00", '{"callsign": "ALPHA 1"}'),
+    ("ENY-001", "enemy", "enemy", 50.2, 8.7, "2024-01-02T00:00:00+00:00", "{}"),
+    ("UNK-001", "unknown", "other", -1.5, 0.0, "2024-01-03T00:00:00+00:00", '{"n": 1}'),
+]
+
+
+def _snapshot(path):
+    conn = sqlite3.connect(path)
+    try:
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='tracks'").fetchone()[0]
+        tables = sorted(r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        rows = sorted(conn.execute("SELECT uid, side, layer, lat, lon, updated_at, meta_json FROM tracks"))
+        return sql, tables, rows
+    finally:
+        conn.close()
+
+
+def test_init_db_migrates_legacy_rowid_table(tmp_path, monkeypatch):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_TRACKS_SQL)
+    conn.executemany("INSERT INTO tracks VALUES(?,?,?,?,?,?,?)", LEGACY_ROWS)
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(main, "DB_PATH", path)
+    main.close_db()
+    try:
+        main.init_db()
+        main.close_db()
+        sql, tables, rows = _snapshot(path)
+        assert "WITHOUT ROWID" in sql.upper()
+        assert tables == ["tracks"]
+        assert rows == sorted(LEGACY_ROWS)
+
+        main.init_db()
+        main.close_db()
+        assert _snapshot(path) == (sql, tables, rows)
+    finally:
+        main.close_db()
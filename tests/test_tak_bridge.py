@@ -0,0 +1,112 @@
+import socket
+import threading
+
+import pytest
+
+from lxml import etree
+
+from tak_bridge import COT_PARSER, TAKBridge, _classify, classify_cot_type
+
+
+def ev(uid: str) -> bytes:
+    return (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<event version="2.0" uid="' + uid.encode() + b'" type="a-f-G-U-C" how="m-g">'
+        b'<point lat="1.5" lon="2.5" hae="0" ce="25" le="25"/>'
+        b'<detail><contact callsign="CS-' + uid.encode() + b'"/></detail></event>'
+    )
+
+
+def ingest(payload: bytes, chunk_size: int = 0):
+    """Stream payload through TAKBridge._stream_recv and return the stored rows."""
+    rows = []
+    bridge = TAKBridge("localhost", 0, upsert_many_fn=rows.extend)
+    bridge._running = True
+    recv_sock, send_sock = socket.socketpair()
+
+    def send():
+        step = chunk_size or len(payload)
+        for i in range(0, len(payload), step):
+            send_sock.sendall(payload[i:i + step])
+        send_sock.close()
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    try:
+        bridge._stream_recv(recv_sock)
+    finally:
+        sender.join()
+        recv_sock.close()
+    return rows
+
+
+def uids(rows):
+    return [row[0] for row in rows]
+
+
+def test_parses_events_split_across_chunks():
+    rows = ingest(ev("A") + ev("B") + ev("C"), chunk_size=7)
+    assert uids(rows) == ["A", "B", "C"]
+    uid, side, layer, lat, lon, meta = rows[0]
+    assert (side, layer, lat, lon) == ("friendly", "friendly", 1.5, 2.5)
+    assert meta["callsign"] == "CS-A"
+    assert meta["source"] == "tak_server"
+
+
+@pytest.mark.parametrize("junk", [
+    b" & ",
+    b"</foo>",
+    b"hello && <<",
+    b'<event uid="BAD"><point lat="1" lon=</event>',
+])
+def test_malformed_fragment_only_loses_itself(junk):
+    assert uids(ingest(ev("A") + junk + ev("B") + ev("C"))) == ["A", "B", "C"]
+
+
+def test_leading_junk_before_first_event():
+    assert uids(ingest(b"hello && <<" + ev("F") + ev("G"))) == ["F", "G"]
+
+
+def test_malformed_fragment_does_not_stall_long_stream():
+    good = [ev("T%d" % i) for i in range(12000)]
+    rows = ingest(ev("A") + b"&" + b"".join(good), chunk_size=4096)
+    assert len(rows) == 12001
+
+
+def test_skips_own_heartbeat():
+    rows = ingest(ev("COP-LITE") + ev("A"))
+    assert uids(rows) == ["A"]
+
+
+def test_external_entities_are_not_loaded(tmp_path):
+    secret = tmp_path / "secret.txt"
+    secret.write_text("TOP-SECRET")
+    doc = (
+        b'<!DOCTYPE event [<!ENTITY x SYSTEM "' + secret.as_uri().encode() + b'">]>'
+        b'<event uid="X"><detail><remarks>&x;</remarks></detail></event>'
+    )
+    root = etree.fromstring(doc, COT_PARSER)
+    assert b"TOP-SECRET" not in etree.tostring(root)
+
+
+@pytest.mark.parametrize("cot_type, expected", [
+    ("a-f-G-U-C", ("friendly", "friendly", "SFGP------*****")),
+    ("a-f-A-M-F", ("friendly", "friendly", "SFAP------*****")),
+    ("a-h-A", ("enemy", "enemy", "SHAP------*****")),
+    ("a-n-G", ("neutral", "other", "SNGP------*****")),
+    ("a-u-A-C", ("unknown", "other", "SUAP------*****")),
+    ("b-m-p-s-m", ("unknown", "other", "SUGP------*****")),
+    ("a-f", ("friendly", "friendly", "SFGP------*****")),
+    ("", ("unknown", "other", "SUGP------*****")),
+])
+def test_classify_cot_type(cot_type, expected):
+    assert classify_cot_type(cot_type) == expected
+
+
+def test_classify_cot_type_caches_on_prefix_only():
+    _classify.cache_clear()
+    assert classify_cot_type("a-f-G-U-C-" + "X" * 100_000) == ("friendly", "friendly", "SFGP------*****")
+    classify_cot_type("a-f-G-U-C-I")
+    classify_cot_type("a-f-G-E-V")
+    info = _classify.cache_info()
+    assert (info.currsize, info.hits) == (1, 2)